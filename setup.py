@@ -54,6 +54,8 @@ extensions = [
                   include_dirs=[get_include()]),
     Extension("size_constrained_clustering.sklearn_import.utils.sparsefuncs_fast", [os.path.join(path, "size_constrained_clustering/sklearn_import/utils/sparsefuncs_fast.pyx")],
                       include_dirs=[get_include()]),
+    Extension("size_constrained_clustering._da_core", [os.path.join(path, "size_constrained_clustering/_da_core.pyx")],
+              extra_compile_args=["-fopenmp", "-O3"], extra_link_args=["-fopenmp"]),
 ]
 
 CYTHONIZE = bool(int(os.getenv("CYTHONIZE", 1))) and cythonize is not None
@@ -64,6 +66,12 @@ if CYTHONIZE:
 else:
     extensions = no_cythonize(extensions)
 
+# set after cythonize, which does not keep it. Compilers without OpenMP (e.g. Apple
+# clang) skip _da_core with a warning and da.py falls back to the numpy iteration
+for extension in extensions:
+    if extension.name == "size_constrained_clustering._da_core":
+        extension.optional = True
+
 with open(os.path.join(path, "requirements.txt")) as fp:
     install_requires = fp.read().strip().split("\n")
 
@@ -0,0 +1,120 @@
+#-*-coding:utf-8-*-
+
+'''
+@file: _da_core.pyx, one deterministic annealing iteration with OpenMP
+'''
+import numpy as np
+cimport cython
+cimport openmp
+from cython.parallel import prange, threadid
+from libc.math cimport exp, INFINITY
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def da_iter(const double[:, ::1] X,
+            const double[:, ::1] centers,
+            const double[::1] lamb,
+            double[::1] eta,
+            const double[::1] demands_prob,
+            double beta,
+            double eta_floor,
+            double[:, ::1] gibbs_out,
+            double[:, ::1] centers_out):
+    '''
+    Distance, eta, gibbs and centers update of DeterministicAnnealing for the
+    squared euclidean distance, parallel over points. eta is updated in place.
+
+    Args:
+        X: shape (n_samples, n_features)
+        centers: shape (n_clusters, n_features), current centers
+        lamb: shape (n_clusters,), target distribution
+        eta: shape (n_clusters,), eta of the previous iteration
+        demands_prob: shape (n_samples,), normalized demands
+        beta (float): inverse temperature, already divided by the T scale
+        eta_floor (float): lower bound of the normalized eta
+        gibbs_out: shape (n_samples, n_clusters), filled with gibbs
+        centers_out: shape (n_clusters, n_features), filled with new centers
+
+    Returns:
+        n_nonzero (int): number of non-zero entries of exp(-beta * d)
+    '''
+    cdef Py_ssize_t n_samples = X.shape[0]
+    cdef Py_ssize_t n_features = X.shape[1]
+    cdef Py_ssize_t n_clusters = centers.shape[0]
+    cdef int n_threads = openmp.omp_get_max_threads()
+    cdef Py_ssize_t i, j, f, tid
+    cdef Py_ssize_t n_nonzero = 0
+    cdef double diff, dist, d_min, e, g, w, row_sum, eta_max
+
+    # thread local accumulators, reduced after each parallel pass
+    cdef double[:, ::1] local_col_sum = np.zeros((n_threads, n_clusters))
+    cdef double[:, ::1] local_p_y = np.zeros((n_threads, n_clusters))
+    cdef double[:, ::1] local_divide_up = np.zeros((n_threads, n_clusters * n_features))
+    cdef double[::1] col_sum = np.zeros(n_clusters)
+    cdef double[::1] p_y = np.zeros(n_clusters)
+
+    # exp(-beta * (d - d_min)), row sums and demand weighted column sums for eta
+    for i in prange(n_samples, nogil=True, schedule='static', num_threads=n_threads):
+        tid = threadid()
+        d_min = INFINITY
+        for j in range(n_clusters):
+            dist = 0.
+            for f in range(n_features):
+                diff = X[i, f] - centers[j, f]
+                dist = dist + diff * diff
+            gibbs_out[i, j] = dist
+            if dist < d_min:
+                d_min = dist
+        row_sum = 0.
+        for j in range(n_clusters):
+            e = exp(- beta * (gibbs_out[i, j] - d_min))
+            gibbs_out[i, j] = e
+            row_sum = row_sum + e * eta[j]
+            if e != 0.:
+                n_nonzero += 1
+        w = demands_prob[i] / row_sum
+        for j in range(n_clusters):
+            local_col_sum[tid, j] += w * gibbs_out[i, j]
+
+    # eta update, same guards as DeterministicAnnealing.update_eta
+    eta_max = 0.
+    for j in range(n_clusters):
+        for tid in range(n_threads):
+            col_sum[j] += local_col_sum[tid, j]
+        if col_sum[j] > 0. and lamb[j] / col_sum[j] < INFINITY:
+            eta[j] = lamb[j] / col_sum[j]
+        if eta[j] > eta_max:
+            eta_max = eta[j]
+    for j in range(n_clusters):
+        eta[j] = max(eta[j] / eta_max, eta_floor)
+
+    # gibbs and weighted sums for the centers
+    for i in prange(n_samples, nogil=True, schedule='static', num_threads=n_threads):
+        tid = threadid()
+        row_sum = 0.
+        for j in range(n_clusters):
+            row_sum = row_sum + gibbs_out[i, j] * eta[j]
+        for j in range(n_clusters):
+            g = gibbs_out[i, j] * eta[j] / row_sum
+            gibbs_out[i, j] = g
+            w = demands_prob[i] * g
+            local_p_y[tid, j] += w
+            for f in range(n_features):
+                local_divide_up[tid, j * n_features + f] += w * X[i, f]
+
+    for j in range(n_clusters):
+        for tid in range(n_threads):
+            p_y[j] += local_p_y[tid, j]
+        for f in range(n_features):
+            if p_y[j] > 0.:
+                centers_out[j, f] = 0.
+                for tid in range(n_threads):
+                    centers_out[j, f] += local_divide_up[tid, j * n_features + f]
+                centers_out[j, f] /= p_y[j]
+            else:
+                # no point is assigned to the cluster, keep its previous center
+                centers_out[j, f] = centers[j, f]
+
+    return n_nonzero
@@ -10,6 +10,10 @@ from scipy.spatial.distance import cdist
 import numpy as np 
 import warnings
 import scipy.sparse as sp
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
 
 import os 
 import sys 
@@ -37,6 +41,18 @@ class Base(object):
         if distance_func is not None and not callable(distance_func):
             raise Exception("Distance function is not callable")
         self.distance_func = distance_func
+        # optional SIMD pairwise distance kernels
+        self._simsimd = simsimd
+
+    def __getstate__(self):
+        # modules can not be pickled, e.g. when sent to joblib workers
+        state = self.__dict__.copy()
+        state.pop('_simsimd', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._simsimd = simsimd
 
     def fit(self, X):
         pass 
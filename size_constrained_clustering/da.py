@@ -14,6 +14,9 @@ import numpy as np
 import os
 import random
 import sys
+import warnings
+from joblib import Parallel, delayed
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
 from tqdm import tqdm
 from typing import Dict, Tuple
@@ -21,8 +24,26 @@ from typing import Dict, Tuple
 path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(path)
 import base
+try:
+    # compiled OpenMP iteration, built by setup.py
+    from _da_core import da_iter
+except ImportError:
+    da_iter = None
 
 logger = logging.getLogger(__name__)
+# lower bound of the normalized eta
+ETA_FLOOR = 1e-150
+# bytes of one (block, n_clusters) tile, sized for L2 cache
+TILE_BYTES = 256 * 1024
+# the compiled iteration loops over features, BLAS is faster above it
+DA_CORE_MAX_FEATURES = 4
+# exp(-x) is exactly 0 in float64 beyond it
+EXP_UNDERFLOW = 746.
+# points sampled to estimate the nearest neighbor scale of T, queried on a k-d tree
+# up to T_SCALE_KDTREE_MAX_FEATURES, the brute force search above it uses fewer points
+T_SCALE_SAMPLES = 1000
+T_SCALE_BRUTE_SAMPLES = 100
+T_SCALE_KDTREE_MAX_FEATURES = 8
 
 
 class DeterministicAnnealing(base.Base):
@@ -33,18 +54,34 @@ class DeterministicAnnealing(base.Base):
                  distance_func=cdist, random_state=42,
                  T=(1000, 100, 10, 1, 0.1, 1e-2, 1e-3, 1e-4, 1e-5, 1e-6, 1e-7, 1e-8),
                  show_progress=True,
-                 debug=False):
+                 debug=False,
+                 dtype=None,
+                 tol=1e-6,
+                 n_jobs=1):
         '''
         Args:
             n_clusters (int): number of clusters
             distribution (list): a list of ratio distribution for each cluster
-            T (list): inverse choice of beta coefficients
+            T (list): inverse choice of beta coefficients. With the default euclidean
+                distance the annealing works on squared distances and T is multiplied by
+                the median nearest neighbor distance of X, see _rescale_T
+            dtype (str/None): precision of X in the euclidean distance step, 'f32', 'f16'
+                or 'i8', by default None, X is used as it is. 'f16' and 'i8' need simsimd.
+                Center moves below the quantization step count as unchanged labels,
+                see _center_resolution
+            tol (float): stop the current T once gibbs is hard and centers move less than tol
+            n_jobs (int): number of processes annealing the T in parallel, -1 for all CPUs.
+                With n_jobs > 1 every T starts from its own initial centers instead
+                of the previous solution, by default 1
         '''
         super(DeterministicAnnealing, self).__init__(n_clusters, max_iters, distance_func)
         self.lamb = distribution
         assert np.sum(distribution).round(3) == 1
         assert len(distribution) == n_clusters
         assert isinstance(T, list) or isinstance(T, tuple) or T is None
+        assert dtype in (None, 'f32', 'f16', 'i8')
+        assert tol >= 0
+        assert isinstance(n_jobs, int) and n_jobs != 0
 
         self.beta = None
         self.T = T[:max_cycles]
@@ -53,11 +90,32 @@ class DeterministicAnnealing(base.Base):
         self.labels_ = None
         self._eta = None
         self._demands_prob = None
+        self._Xw = None
         self.debug = debug
         self.labels_unchanged = 0
         self.labels_unchanged_threshold = labels_unchanged_threshold
         self.prev_labels = None
+        self._X_norm_sq = None
+        self._X_mean = None
+        self._centers_T = None
+        self._D_cache = None
+        self._cache_centers = None
+        self._T_scale = 1.
+        self._use_da_core = False
+        self._fixed_rows = None
+        self._fixed_cluster_of = None
+        self._is_hard_assigned = False
+        self.dtype = dtype
+        self.tol = tol
+        self.n_jobs = n_jobs
+        self._X_q = None
+        self._Xq_scale = None
+        self._Xq_zero = None
+        self._Xq_dtype = None
+        self._Xq_norm_sq = None
+        self._center_resolution = 0.
         self.show_progress = show_progress
+        self.random_state = np.random.RandomState(random_state)
         random.seed(random_state)
         np.random.seed(random_state)
         logger.debug(f'Temperature: {self.T}')
@@ -66,9 +124,22 @@ class DeterministicAnnealing(base.Base):
         # setting T, loop
         solutions = []
         diff_list = []
-        is_early_terminated = False
 
+        X = self._as_float(X)
         n_samples, n_features = X.shape
+        # the euclidean annealing is translation invariant, on centered X neither the
+        # ||x||^2 + ||c||^2 - 2 x.c distance nor the rounding floor of the center sums
+        # depend on the offset of X. Other distance functions get X as it is
+        self._X_mean = X.mean(axis=0) if self.distance_func is cdist else np.zeros(n_features)
+        X = X - self._X_mean
+        self._X_norm_sq = np.einsum('ij,ij->i', X, X)
+        self._X_q = None
+        # rounding floor of the n_samples terms center sums
+        self._center_resolution = n_samples * np.finfo(X.dtype).eps * np.abs(X).max()
+        if self.dtype is not None and self.distance_func is cdist:
+            self._X_q = self._fit_quantizer(X)
+        # squared distance changes the unit of T, keep it comparable to the euclidean one
+        self._T_scale = self._rescale_T(X) if self.distance_func is cdist else 1.
         self.capacity = [n_samples * d for d in self.lamb]
         if demands_prob is None:
             demands_prob = np.ones((n_samples, 1))
@@ -76,90 +147,360 @@ class DeterministicAnnealing(base.Base):
             demands_prob = np.asarray(demands_prob).reshape((-1, 1))
             assert demands_prob.shape[0] == X.shape[0]
         demands_prob = demands_prob / sum(demands_prob)
-        for t in self.T:
-            logger.debug(f'Current T: {t}')
-            self.t = t
+        # the compiled iteration covers euclidean distance without anchors in low dimension
+        self._use_da_core = da_iter is not None and self.distance_func is cdist \
+            and self._X_q is None and not fixed_points and n_features <= DA_CORE_MAX_FEATURES
+        if self._use_da_core:
+            X = np.ascontiguousarray(X, dtype=np.float64)
+            demands_prob = np.ascontiguousarray(demands_prob, dtype=np.float64)
+        # demands are constant over iterations, weight X once
+        self._Xw = X * demands_prob
+        self._fixed_rows, self._fixed_cluster_of = None, None
+        if fixed_points:
+            self._fixed_rows, self._fixed_cluster_of = self._fixed_points_index(fixed_points)
+        self._D_cache = None
+
+        if self.n_jobs == 1:
+            distance_buffer, gibbs_buffer = self._init_buffers(n_samples)
+            # each T is warm started from the previous solution
             centers = self.initial_centers(X)
-
-            if fixed_points:
-                centers = self.set_centers_for_anchors(centers, X, fixed_points)
-
             eta = self.lamb
             labels = None
+            for t in self.T:
+                if labels is not None:
+                    # previous T lost clusters, only reseed the collapsed ones
+                    collapsed = np.bincount(labels, minlength=self.n_clusters) == 0
+                    centers = centers.copy()
+                    centers[collapsed] = self.initial_centers(X)[collapsed]
+                    eta = np.array(eta, dtype=np.float64)
+                    eta[collapsed] = 1.
+                labels, eta, centers = self._anneal(X, t, centers, eta, demands_prob, fixed_points,
+                                                    distance_buffer, gibbs_buffer)
+                solutions.append([labels, centers, eta, self.beta])
+                resultant_clusters = np.count_nonzero(np.bincount(labels, minlength=self.n_clusters))
+                diff_list.append(abs(resultant_clusters - self.n_clusters))
+                if resultant_clusters == self.n_clusters:
+                    break
+        else:
+            # independent T, seeded here so that results do not depend on the workers
+            initial_centers = [self.initial_centers(X) for _ in self.T]
+            solutions = Parallel(n_jobs=self.n_jobs, verbose=0)(
+                delayed(_run_single_T)(self, X, t, centers, demands_prob, fixed_points)
+                for t, centers in zip(self.T, initial_centers))
+            for labels, centers, eta, beta in solutions:
+                resultant_clusters = np.count_nonzero(np.bincount(labels, minlength=self.n_clusters))
+                diff_list.append(abs(resultant_clusters - self.n_clusters))
 
-            for i in tqdm(range(self.max_iters), disable=not self.show_progress):
-                self.beta = 1. / self.t
-                distance_matrix = self.distance_func(X, centers)
-                eta = self.update_eta(eta, demands_prob, distance_matrix)
-                gibbs = self.update_gibbs(eta, distance_matrix)
-                if fixed_points:
-                    gibbs = self.set_gibbs_fixed_points(gibbs, fixed_points)
-                centers = self.update_centers(demands_prob, gibbs, X)
-                if fixed_points:
-                    centers = self.set_centers_for_anchors(centers, X, fixed_points)
-                self.t *= 0.999
+        # modification for non-strictly satisfaction, only works for one demand per location
+        # labels = self.modify(labels, centers, distance_matrix)
+        # first T reaching n_clusters, otherwise the closest one
+        best_index = np.argmin(diff_list)
+        labels, centers, eta, self.beta = solutions[best_index]
 
-                labels = np.argmax(gibbs, axis=1)
+        self.cluster_centers_ = centers + self._X_mean
+        self.labels_ = labels
+        self._eta = eta
+        self._demands_prob = demands_prob
+        self._release_buffers()
 
-                self.on_iter_end(i, X, eta, gibbs, centers, labels)
-                if self.break_condition(labels): break
+    def _release_buffers(self):
+        '''
+        Drop the per-fit (n_samples, n_features) and (n_samples, n_clusters)
+        work arrays, predict does not use them and they would be pickled
+        '''
+        self._Xw = None
+        self._X_norm_sq = None
+        self._D_cache = None
+        self._cache_centers = None
+        self._X_q = None
+        self._Xq_norm_sq = None
+        self._fixed_rows, self._fixed_cluster_of = None, None
+
+    def _init_buffers(self, n_samples):
+        '''
+        (n_samples, n_clusters) buffers reused by every iteration of a fit,
+        the distance cache is allocated when the distance step can use it
 
-                self.prev_labels = labels
+        Returns:
+            distance_buffer, gibbs_buffer
+        '''
+        distance_buffer = np.empty((n_samples, self.n_clusters))
+        gibbs_buffer = np.empty_like(distance_buffer)
+        self._D_cache = None
+        if self._X_q is None and self.distance_func is cdist and not self._use_da_core:
+            self._D_cache = np.empty_like(distance_buffer)
+        return distance_buffer, gibbs_buffer
+
+    def _anneal(self, X, t, centers, eta, demands_prob, fixed_points=None,
+                distance_buffer=None, gibbs_buffer=None):
+        '''
+        Anneal from temperature t until one of the break conditions holds
 
-            solutions.append([labels, centers])
-            resultant_clusters = len(collections.Counter(labels))
+        Returns:
+            labels, eta, centers
+        '''
+        logger.debug(f'Current T: {t}')
+        self.t = t
+        if fixed_points:
+            centers = self.set_centers_for_anchors(centers, X, fixed_points)
+        self._centers_T = np.ascontiguousarray(centers.T)
+        self._cache_centers = None
 
-            diff_list.append(abs(resultant_clusters - self.n_clusters))
+        self.prev_labels = None
+        self.labels_unchanged = 0
 
-            if resultant_clusters == self.n_clusters:
-                is_early_terminated = True
+        for i in tqdm(range(self.max_iters), disable=not self.show_progress):
+            self.beta = 1. / (self.t * self._T_scale)
+            prev_centers = centers
+            eta, gibbs, centers = self._da_step(X, centers, eta, demands_prob, fixed_points,
+                                                distance_buffer, gibbs_buffer)
+            if not fixed_points:
+                centers = self._merge_close_centers(centers)
+            self.t *= 0.999
+
+            labels = np.argmax(gibbs, axis=1)
+            # center moves below the rounding floor of the center sums, or below the
+            # quantization step, are noise and labels flipping between nearly equal
+            # centers do not count as changes
+            is_stalled = np.abs(centers - prev_centers).max() <= self._center_resolution
+            if self.prev_labels is not None and (np.array_equal(labels, self.prev_labels) or is_stalled):
+                self.labels_unchanged += 1
+            else:
+                self.labels_unchanged = 0
+
+            self.on_iter_end(i, X, eta, gibbs, centers, labels)
+            if self.break_condition(labels): break
+            # exp(-beta * d) is one-hot on every row and labels are stable,
+            # centers are at a fixed point and lower T cannot change labels
+            if self._is_hard_assigned and self.labels_unchanged > 0:
+                break
+            if self.labels_unchanged >= self.labels_unchanged_threshold:
+                break
+            # every point is assigned with probability ~1 and centers stopped moving
+            if np.linalg.norm(centers - prev_centers) < self.tol \
+                    and gibbs.max(axis=1).min() > 1 - 1e-12:
                 break
 
-        # modification for non-strictly satisfaction, only works for one demand per location
-        # labels = self.modify(labels, centers, distance_matrix)
-        if not is_early_terminated:
-            best_index = np.argmin(diff_list)
-            labels, centers = solutions[best_index]
+            self.prev_labels = labels
+        return labels, eta, centers
 
-        self.cluster_centers_ = centers
-        self.labels_ = labels
-        self._eta = eta
-        self._demands_prob = demands_prob
+    def _as_float(self, X):
+        '''
+        X in float64 like cdist, float32 rounding swamps exp(-beta * d) at low T.
+        Integer X, e.g. grid or pixel coordinates, is converted too. With the dtype
+        quantization of the distance step, float32 X is kept as it is
+        '''
+        X = np.asarray(X)
+        dtype = np.float64 if self.dtype is None else np.result_type(X, np.float32)
+        return np.ascontiguousarray(X, dtype=dtype)
+
+    def _merge_close_centers(self, centers):
+        '''
+        Centers within _center_resolution of a center of lower index take its value.
+        At high T the centers converge to one point and only rounding noise of the
+        summation order tells them apart, merged centers make labels and the
+        clusters reseeded by the warm start the same for every iteration path
+        '''
+        if self.n_clusters == 1:
+            return centers
+        close = np.tril(cdist(centers, centers, metric='chebyshev') <= self._center_resolution, -1)
+        has_close = close.any(axis=1)
+        if not has_close.any():
+            return centers
+        root = np.where(has_close, close.argmax(axis=1), np.arange(self.n_clusters))
+        # follow chains of merged centers to the lowest index
+        while not np.array_equal(root[root], root):
+            root = root[root]
+        centers = centers[root]
+        self._centers_T = np.ascontiguousarray(centers.T)
+        return centers
 
     def predict(self, X):
-        distance_matrix = self.distance_func(X, self.cluster_centers_)
-        eta = self.update_eta(self._eta, self._demands_prob, distance_matrix)
-        gibbs = self.update_gibbs(eta, distance_matrix)
+        X = self._as_float(X)
+        X = X - self._X_mean
+        X_norm_sq = np.einsum('ij,ij->i', X, X)
+        distance_matrix = self._distance(X, self.cluster_centers_ - self._X_mean, X_norm_sq)
+        labels = self._hard_labels(distance_matrix)
+        if labels is not None:
+            return labels
+        exp_term = self._exp_term(distance_matrix)
+        eta = self.update_eta(self._eta, self._demands_prob, exp_term)
+        gibbs = self.update_gibbs(eta, exp_term)
         labels = np.argmax(gibbs, axis=1)
         return labels
 
+    def _hard_labels(self, distance_matrix):
+        '''
+        Labels by argmin of the distance when every row is in the hard assignment
+        regime: beta times the gap between its two smallest distances underflows
+        exp, so gibbs would be one-hot on the closest center whatever eta is
+
+        Returns:
+            labels (array like/None): None if some row is still soft
+        '''
+        if self.beta is None:
+            return None
+        if self.n_clusters == 1:
+            return np.zeros(distance_matrix.shape[0], dtype=np.intp)
+        two_smallest = np.partition(distance_matrix, 1, axis=1)
+        if self.beta * (two_smallest[:, 1] - two_smallest[:, 0]).min() <= EXP_UNDERFLOW:
+            return None
+        return np.argmin(distance_matrix, axis=1)
+
+    def _distance(self, X, centers, X_norm_sq, centers_T=None, out=None):
+        '''
+        Distance between X and centers, user defined distance_func is respected.
+        For the default euclidean distance only exp(-beta * d) is used downstream,
+        so the squared distance is returned without the sqrt, through simsimd if
+        installed, otherwise the GEMM based _sqdist. out is filled when its dtype
+        allows it, the result is always the returned array
+        '''
+        if self.distance_func is not cdist:
+            return self.distance_func(X, centers)
+        if self._simsimd is not None and X.dtype in (np.float32, np.float64):
+            centers = np.ascontiguousarray(centers, dtype=X.dtype)
+            # the out= form of simsimd.cdist returns None without a reference to it,
+            # which corrupts the refcount of None, so its own array is copied instead
+            sqdist = np.asarray(self._simsimd.cdist(X, centers, metric='sqeuclidean'))
+            if out is not None and out.dtype == np.float64:
+                out[...] = sqdist
+                return out
+            return sqdist
+        if centers_T is None:
+            centers_T = np.ascontiguousarray(centers.T)
+        return self._sqdist(X, centers_T, X_norm_sq, out)
+
+    def _sqdist(self, X, centers_T, X_norm_sq, out=None):
+        '''
+        Squared euclidean distance ||x||^2 + ||c||^2 - 2 x.c, one BLAS GEMM
+        instead of pairwise loops
+
+        Args:
+            X (array like): shape (n_samples, n_features)
+            centers_T (array like): shape (n_features, n_clusters), transposed centers
+            X_norm_sq (array like): shape (n_samples,), squared norms of X
+            out (array like/None): shape (n_samples, n_clusters), used if dtype matches
+        '''
+        centers_norm_sq = np.einsum('ij,ij->j', centers_T, centers_T)
+        if out is not None and out.dtype != np.result_type(X, centers_T):
+            out = None
+        sqdist = np.dot(X, centers_T, out=out)
+        sqdist *= -2.
+        sqdist += X_norm_sq[:, None]
+        sqdist += centers_norm_sq[None, :]
+        # remove negative values from rounding errors
+        return np.maximum(sqdist, 0., out=sqdist)
+
+    def _fit_quantizer(self, X):
+        '''
+        Quantize X once for the distance step. int8 uses a per-feature zero point
+        and one shared scale, so that the squared distance is only rescaled by scale^2
+        '''
+        dtype = self.dtype
+        if dtype in ('f16', 'i8') and self._simsimd is None:
+            warnings.warn("simsimd is not installed, distance step falls back to f32")
+            dtype = 'f32'
+        self._Xq_dtype = dtype
+        self._Xq_scale, self._Xq_zero = None, None
+        if dtype == 'i8':
+            x_min, x_max = X.min(axis=0), X.max(axis=0)
+            self._Xq_zero = (x_max + x_min) / 2.
+            scale = np.max(x_max - x_min) / 2. / 127.
+            self._Xq_scale = scale if scale > 0 else 1.
+            step = self._Xq_scale
+        else:
+            step = np.finfo(np.float16 if dtype == 'f16' else np.float32).eps * np.abs(X).max()
+        self._center_resolution = max(self._center_resolution, step)
+        X_q = self._quantize(X)
+        if self._simsimd is None:
+            self._Xq_norm_sq = np.einsum('ij,ij->i', X_q, X_q)
+        return X_q
+
+    def _quantize(self, A):
+        if self._Xq_dtype == 'f32':
+            return np.ascontiguousarray(A, dtype=np.float32)
+        if self._Xq_dtype == 'f16':
+            return np.ascontiguousarray(A, dtype=np.float16)
+        A_q = np.rint((A - self._Xq_zero) / self._Xq_scale)
+        return np.ascontiguousarray(np.clip(A_q, -127, 127), dtype=np.int8)
+
+    def _quantized_distance(self, centers):
+        '''
+        Squared distance between the quantized X and centers, centers are
+        requantized on every call since they move each iteration
+        '''
+        centers_q = self._quantize(centers)
+        if self._simsimd is not None:
+            sqdist = np.asarray(self._simsimd.cdist(self._X_q, centers_q, metric='sqeuclidean'),
+                                dtype=np.float32)
+        else:
+            sqdist = self._sqdist(self._X_q, np.ascontiguousarray(centers_q.T), self._Xq_norm_sq)
+        if self._Xq_scale is not None:
+            sqdist *= self._Xq_scale ** 2
+        return sqdist
+
     def modify(self, labels, centers, distance_matrix):
         centers_distance = self.distance_func(centers, centers)
-        adjacent_centers = {i: np.argsort(centers_distance, axis=1)[i, 1:3].tolist() for i in range(self.n_clusters)}
+        adjacent_centers = np.argsort(centers_distance, axis=1)[:, 1:3]
+        capacity = np.asarray(self.capacity)
         while not self._is_satisfied(labels):
-            count = collections.Counter(labels)
-            cluster_id_list = list(count.keys())
+            count = np.bincount(labels, minlength=self.n_clusters)
+            cluster_id_list = np.where(count > capacity)[0]
             random.shuffle(cluster_id_list)
             for cluster_id in cluster_id_list:
-                num_points = count[cluster_id]
-                diff = num_points - self.capacity[cluster_id]
-                if diff <= 0:
-                    continue
-                adjacent_cluster = None
+                diff = int(np.ceil(count[cluster_id] - capacity[cluster_id]))
                 adjacent_cluster = random.choice(adjacent_centers[cluster_id])
-                if adjacent_cluster is None:
-                    continue
-                cluster_point_id = np.where(labels == cluster_id)[0].tolist()
+                cluster_point_id = np.where(labels == cluster_id)[0]
                 diff_distance = distance_matrix[cluster_point_id, adjacent_cluster] \
                                 - distance_matrix[cluster_point_id, cluster_id]
-                remove_point_id = np.asarray(cluster_point_id)[np.argsort(diff_distance)[:diff]]
+                # closest diff points to the adjacent cluster, no full sort needed
+                remove_point_id = cluster_point_id[np.argpartition(diff_distance, diff - 1)[:diff]]
                 labels[remove_point_id] = adjacent_cluster
 
         return labels
 
+    def _rescale_T(self, X):
+        '''
+        Scale of T for the squared euclidean distance: the median nearest neighbor
+        distance s of X, estimated on sampled points. With beta = 1 / (t * s),
+        exp(-beta * d^2) equals exp(-d / t) at d = s, so T tuned for the euclidean
+        distance still works. In low dimension the neighbors come from a k-d tree,
+        otherwise from a tiled brute force search, which costs about
+        T_SCALE_BRUTE_SAMPLES / n_clusters distance steps
+
+        Returns:
+            scale (float): 1 if it can not be estimated
+        '''
+        n_samples, n_features = X.shape
+        if n_samples < 2:
+            return 1.
+        if n_features <= T_SCALE_KDTREE_MAX_FEATURES:
+            sample = np.unique(np.linspace(0, n_samples - 1, min(n_samples, T_SCALE_SAMPLES)).astype(int))
+            # the first neighbor of a sampled point is itself
+            nn_dist, _ = cKDTree(X).query(X[sample], k=2)
+            scale = np.median(nn_dist[:, 1])
+            return float(scale) if np.isfinite(scale) and scale > 0 else 1.
+        sample = np.unique(np.linspace(0, n_samples - 1, min(n_samples, T_SCALE_BRUTE_SAMPLES)).astype(int))
+        sample_T = np.ascontiguousarray(X[sample].T)
+        nn_sqdist = np.full(len(sample), np.inf)
+        block_size = max(1, TILE_BYTES // (8 * len(sample)))
+        for start in range(0, n_samples, block_size):
+            stop = min(start + block_size, n_samples)
+            sqdist = self._sqdist(X[start:stop], sample_T, self._X_norm_sq[start:stop])
+            # a sampled point is not its own neighbor
+            own = np.where((sample >= start) & (sample < stop))[0]
+            sqdist[sample[own] - start, own] = np.inf
+            np.minimum(nn_sqdist, sqdist.min(axis=0), out=nn_sqdist)
+        scale = np.sqrt(np.median(nn_sqdist))
+        return float(scale) if np.isfinite(scale) and scale > 0 else 1.
+
     def initial_centers(self, X):
-        selective_centers = random.sample(range(X.shape[0]), self.n_clusters)
-        centers = X[selective_centers]
+        '''
+        k-means++ seeding of base.k_init, sampled on the squared euclidean distance
+        '''
+        X_squared_norm = np.einsum('ij,ij->i', X, X)
+        centers = base.k_init(X, self.n_clusters, X_squared_norm, self.random_state,
+                              distance_func=lambda A, B: cdist(A, B, metric='sqeuclidean'))
         return centers
 
     def set_centers_for_anchors(self, centers, X, fixed_points: Dict[int, Tuple[int]]):
@@ -171,52 +512,218 @@ class DeterministicAnnealing(base.Base):
         return self._is_satisfied(labels)
 
     def _is_satisfied(self, labels):
-        count = collections.Counter(labels)
-        for cluster_id in range(len(self.capacity)):
-            if cluster_id not in count:
-                return False
-            num_points = count[cluster_id]
-            if num_points > self.capacity[cluster_id]:
-                return False
-        return True
-
-    def update_eta(self, eta, demands_prob, distance_matrix):
-        n_points, n_centers = distance_matrix.shape
-        eta_repmat = np.tile(np.asarray(eta).reshape(1, -1), (n_points, 1))
-        exp_term = np.exp(- self.beta * distance_matrix)
-        divider = exp_term / np.sum(np.multiply(exp_term,
-                                                eta_repmat), axis=1).reshape((-1, 1))
-        eta = np.divide(np.asarray(self.lamb),
-                        np.sum(divider * demands_prob, axis=0))
+        count = np.bincount(labels, minlength=self.n_clusters)
+        return bool((count > 0).all() and (count <= np.asarray(self.capacity)).all())
+
+    def _da_step(self, X, centers, eta, demands_prob, fixed_points=None,
+                 distance_buffer=None, gibbs_buffer=None):
+        '''
+        One annealing iteration at the current beta: distance, eta, gibbs and
+        centers update. Only the distance and the gibbs matrix are materialized
+        with shape (n_samples, n_clusters), reductions go through BLAS. Given
+        buffers of that shape are reused, exp_term overwrites distance_buffer.
+        After the distance, points are processed in tiles of TILE_BYTES, so
+        the passes of exp, normalization and sums stay in cache
+
+        Returns:
+            eta, gibbs, centers
+        '''
+        if self._use_da_core:
+            return self._da_core_step(X, centers, eta, demands_prob, gibbs_buffer)
+        if self._X_q is not None:
+            distance_matrix = self._quantized_distance(centers)
+        elif self._D_cache is not None:
+            distance_matrix = self._cached_distance(X, centers)
+        else:
+            distance_matrix = self._distance(X, centers, self._X_norm_sq, self._centers_T,
+                                             out=distance_buffer)
+        n_samples = X.shape[0]
+        if distance_buffer is None:
+            distance_buffer = np.empty((n_samples, self.n_clusters))
+        if gibbs_buffer is None:
+            gibbs_buffer = np.empty_like(distance_buffer)
+        block_size = max(1, TILE_BYTES // (distance_buffer.itemsize * self.n_clusters))
+        blocks = [slice(start, min(start + block_size, n_samples))
+                  for start in range(0, n_samples, block_size)]
+        w = demands_prob.ravel()
+        Xw = self._Xw if self._Xw is not None else X * demands_prob
+
+        # exp_term and the column sums of the eta update
+        exp_term = distance_buffer
+        col_sum = 0.
+        n_nonzero = 0
+        for block in blocks:
+            exp_block = self._exp_term(distance_matrix[block], out=exp_term[block])
+            n_nonzero += np.count_nonzero(exp_block)
+            col_sum = col_sum + self._eta_column_sum(eta, w[block], exp_block)
+        self._is_hard_assigned = n_nonzero == n_samples
+        eta = self._eta_from_column_sum(eta, col_sum)
+
+        # gibbs and the weighted sums of the centers update. A one-hot exp_term
+        # normalizes to itself, so it is used as gibbs
+        gibbs = exp_term if self._is_hard_assigned else gibbs_buffer
+        divide_up, p_y = 0., 0.
+        for block in blocks:
+            if self._is_hard_assigned:
+                gibbs_block = exp_term[block]
+            else:
+                gibbs_block = self.update_gibbs(eta, exp_term[block], out=gibbs[block])
+            if not fixed_points:
+                block_divide_up, block_p_y = self._center_sums(w[block], gibbs_block, Xw[block])
+                divide_up, p_y = divide_up + block_divide_up, p_y + block_p_y
+        if fixed_points:
+            if self._fixed_rows is not None:
+                # index of the fixed points of the current fit
+                gibbs = self._set_gibbs_fixed_rows(gibbs, self._fixed_rows, self._fixed_cluster_of)
+            else:
+                gibbs = self.set_gibbs_fixed_points(gibbs, fixed_points)
+            divide_up, p_y = self._center_sums(w, gibbs, Xw)
+        centers = self._centers_from_sums(divide_up, p_y)
+        if fixed_points:
+            centers = self.set_centers_for_anchors(centers, X, fixed_points)
+            self._centers_T = np.ascontiguousarray(centers.T)
+        return eta, gibbs, centers
+
+    def _da_core_step(self, X, centers, eta, demands_prob, gibbs_buffer=None):
+        '''
+        _da_step through the compiled da_iter, one parallel call per iteration
+        '''
+        n_samples = X.shape[0]
+        if gibbs_buffer is None:
+            gibbs_buffer = np.empty((n_samples, self.n_clusters))
+        centers = np.ascontiguousarray(centers, dtype=np.float64)
+        eta = np.array(eta, dtype=np.float64)
+        new_centers = np.empty_like(centers)
+        n_nonzero = da_iter(X, centers, np.asarray(self.lamb, dtype=np.float64), eta,
+                            demands_prob.ravel(), self.beta, ETA_FLOOR, gibbs_buffer, new_centers)
+        self._is_hard_assigned = n_nonzero == n_samples
+        self._centers_T = np.ascontiguousarray(new_centers.T)
+        return eta, gibbs_buffer, new_centers
+
+    def _cached_distance(self, X, centers):
+        '''
+        Squared euclidean distance table kept across iterations, only columns
+        whose center moved are recomputed. The table is exact: at high T the
+        centers are close to each other and labels depend on tiny distance
+        differences, so no approximation is allowed
+        '''
+        if self._cache_centers is None:
+            moved = np.ones(self.n_clusters, dtype=bool)
+        else:
+            moved = (centers != self._cache_centers).any(axis=1)
+        if moved.all():
+            distance_matrix = self._distance(X, centers, self._X_norm_sq, self._centers_T,
+                                             out=self._D_cache)
+            if distance_matrix is not self._D_cache:
+                self._D_cache[...] = distance_matrix
+            self._cache_centers = centers.copy()
+        elif moved.any():
+            self._D_cache[:, moved] = self._distance(X, centers[moved], self._X_norm_sq)
+            self._cache_centers[moved] = centers[moved]
+        return self._D_cache
+
+    def _exp_term(self, distance_matrix, out=None):
+        '''
+        exp(-beta * d) shared by update_eta and update_gibbs, shifted by the
+        row maximum of the exponent, which cancels in both normalizations.
+        Every row keeps at least one entry equal to 1, so small T cannot turn
+        gibbs into 0 / 0
+        '''
+        z = np.multiply(distance_matrix, - self.beta, out=out)
+        z -= z.max(axis=1, keepdims=True)
+        return np.exp(z, out=z)
+
+    def update_eta(self, eta, demands_prob, exp_term):
+        col_sum = self._eta_column_sum(eta, demands_prob.ravel(), exp_term)
+        return self._eta_from_column_sum(eta, col_sum)
+
+    def _eta_column_sum(self, eta, w, exp_term):
+        # sum_i w_i * exp_ij / sum_j' (exp_ij' * eta_j') as two matrix-vector products
+        row_sum = exp_term.dot(np.asarray(eta, dtype=exp_term.dtype))
+        return (w / row_sum).dot(exp_term)
+
+    def _eta_from_column_sum(self, eta, col_sum):
+        with np.errstate(divide='ignore'):
+            new_eta = np.divide(np.asarray(self.lamb), col_sum)
+        # clusters without any mass keep their eta instead of going to inf
+        invalid = ~np.isfinite(new_eta)
+        new_eta[invalid] = np.asarray(eta, dtype=new_eta.dtype)[invalid]
+        # gibbs is invariant to the scale of eta, keep it in [ETA_FLOOR, 1] so that
+        # row_sum > 0 and col_sum <= 1 / ETA_FLOOR never overflow
+        eta = np.maximum(new_eta / new_eta.max(), ETA_FLOOR)
 
         return eta
 
-    def update_gibbs(self, eta, distance_matrix):
-        n_points, n_centers = distance_matrix.shape
-        eta_repmat = np.tile(np.asarray(eta).reshape(1, -1), (n_points, 1))
-        exp_term = np.exp(- self.beta * distance_matrix)
-        factor = np.multiply(exp_term, eta_repmat)
-        gibbs = factor / np.sum(factor, axis=1).reshape((-1, 1))
+    def update_gibbs(self, eta, exp_term, out=None):
+        gibbs = np.multiply(exp_term, np.asarray(eta)[None, :], out=out)
+        gibbs /= np.sum(gibbs, axis=1).reshape((-1, 1))
         return gibbs
 
     def set_gibbs_fixed_points(self, gibbs, fixed_points):
-        for cluster_id, points_id in fixed_points.items():
-            gibbs[tuple([points_id])] = 0
-            gibbs[[points_id], cluster_id] = 1
+        rows, cluster_of = self._fixed_points_index(fixed_points)
+        return self._set_gibbs_fixed_rows(gibbs, rows, cluster_of)
+
+    def _set_gibbs_fixed_rows(self, gibbs, rows, cluster_of):
+        gibbs[rows, :] = 0
+        gibbs[rows, cluster_of] = 1
         return gibbs
 
+    def _fixed_points_index(self, fixed_points):
+        '''
+        Flatten fixed points into point ids and their cluster ids, a point listed
+        for several clusters belongs to the last one
+        '''
+        rows = np.concatenate([np.asarray(points_id, dtype=np.intp).ravel()
+                               for points_id in fixed_points.values()])
+        cluster_of = np.concatenate([np.full(np.size(points_id), cluster_id, dtype=np.intp)
+                                     for cluster_id, points_id in fixed_points.items()])
+        # keep the last occurrence of every point
+        _, last = np.unique(rows[::-1], return_index=True)
+        last = len(rows) - 1 - last
+        return rows[last], cluster_of[last]
+
     def update_centers(self, demands_prob, gibbs, X):
-        n_points, n_features = X.shape
-        divide_up = gibbs.T.dot(X * demands_prob)  # n_cluster, n_features
-        p_y = np.sum(gibbs * demands_prob, axis=0)  # n_cluster,
-        p_y_repmat = np.tile(p_y.reshape(-1, 1), (1, n_features))
-        centers = np.divide(divide_up, p_y_repmat)
+        divide_up, p_y = self._center_sums(demands_prob.ravel(), gibbs, X * demands_prob)
+        return self._centers_from_sums(divide_up, p_y)
+
+    def _center_sums(self, w, gibbs, Xw):
+        '''
+        Args:
+            w (array like): shape (n_samples,), demands
+            gibbs (array like): shape (n_samples, n_clusters)
+            Xw (array like): shape (n_samples, n_features), X weighted by demands
+        '''
+        divide_up = gibbs.T.dot(Xw)  # n_cluster, n_features
+        p_y = w.dot(gibbs)  # n_cluster,
+        return divide_up, p_y
+
+    def _centers_from_sums(self, divide_up, p_y):
+        empty = p_y <= 0
+        centers = divide_up / np.where(empty, 1., p_y)[:, None]
+        if empty.any():
+            # no point is assigned to the cluster, keep its previous center
+            centers[empty] = self._centers_T.T[empty]
+        self._centers_T = np.ascontiguousarray(centers.T)
         return centers
 
     def on_iter_end(self, i, X, eta, gibbs, centers, labels):
         pass
 
 
+def _run_single_T(model, X, t, centers, demands_prob, fixed_points=None):
+    '''
+    Anneal one T of a fitted model in a worker process, the buffers are
+    allocated here since arrays sent by joblib are read only
+
+    Returns:
+        labels, centers, eta, beta
+    '''
+    distance_buffer, gibbs_buffer = model._init_buffers(X.shape[0])
+    labels, eta, centers = model._anneal(X, t, centers, model.lamb, demands_prob, fixed_points,
+                                         distance_buffer, gibbs_buffer)
+    return labels, centers, eta, model.beta
+
+
 if __name__ == "__main__":
     X = []
     n_points = 1000
@@ -250,3 +757,4 @@ if __name__ == "__main__":
     plt.ylabel("Y")
     # plt.bar(x, y)
     plt.show()
+
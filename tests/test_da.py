@@ -38,4 +38,323 @@ class TestDA:
         label_dist = list(label_counter.values())
         label_dist = [d / np.sum(label_dist) for d in label_dist]
 
-        assert np.sum(np.array(label_dist) - np.array(distribution)) <= 1e-6
+        assert len(label_dist) == n_clusters
+        assert np.abs(np.array(label_dist) - np.array(distribution)).max() <= 0.05
+
+    def test_distance(self):
+        import numpy as np
+        from scipy.spatial.distance import cdist
+        np.random.seed(42)
+        X = np.random.rand(100, 5)
+        centers = np.random.rand(4, 5)
+        model = da.DeterministicAnnealing(4, [0.25] * 4)
+        X_norm_sq = np.sum(np.square(X), axis=1)
+        distance_matrix = model._distance(X, centers, X_norm_sq)
+        assert np.allclose(distance_matrix, cdist(X, centers, metric='sqeuclidean'))
+
+    def test_quantized_distance(self):
+        import numpy as np
+        from scipy.spatial.distance import cdist
+        np.random.seed(42)
+        X = np.random.rand(100, 5)
+        centers = np.random.rand(4, 5)
+        for dtype in ['f32', 'f16', 'i8']:
+            model = da.DeterministicAnnealing(4, [0.25] * 4, dtype=dtype)
+            model._X_q = model._fit_quantizer(X)
+            distance_matrix = model._quantized_distance(centers)
+            assert np.allclose(distance_matrix, cdist(X, centers, metric='sqeuclidean'), atol=5e-2)
+
+    def test_modify(self):
+        import numpy as np
+        from scipy.spatial.distance import cdist
+        np.random.seed(42)
+        X = np.random.rand(200, 2)
+        centers = np.random.rand(4, 2)
+        distance_matrix = cdist(X, centers)
+        labels = np.argmin(distance_matrix, axis=1)
+        model = da.DeterministicAnnealing(4, [0.25] * 4)
+        model.capacity = [200 * 0.3] * 4
+        labels = model.modify(labels, centers, distance_matrix)
+        assert (np.bincount(labels, minlength=4) <= 60).all()
+
+    def test_da_core(self):
+        import numpy as np
+        if da.da_iter is None:
+            pytest.skip("_da_core extension is not built")
+
+        class CountingDA(da.DeterministicAnnealing):
+            n_iters = 0
+            def on_iter_end(self, i, X, eta, gibbs, centers, labels):
+                self.n_iters += 1
+
+        da_iter = da.da_iter
+        try:
+            for seed in [0, 1]:
+                np.random.seed(seed)
+                X = np.random.rand(2000, 2)
+                results = []
+                # compiled and numpy iterations
+                for core in [da_iter, None]:
+                    da.da_iter = core
+                    model = CountingDA(4, [0.25] * 4, show_progress=False)
+                    model.fit(X)
+                    assert model._use_da_core == (core is not None)
+                    results.append((model.n_iters, model.labels_))
+                (core_iters, core_labels), (numpy_iters, numpy_labels) = results
+                assert core_iters == numpy_iters
+                assert (core_labels == numpy_labels).all()
+        finally:
+            da.da_iter = da_iter
+
+    def test_initial_centers(self):
+        import numpy as np
+        from sklearn.datasets import make_blobs
+        X, y = make_blobs(n_samples=400, centers=[(-10, -10), (-10, 10), (10, -10), (10, 10)],
+                          cluster_std=0.5, random_state=42)
+        model = da.DeterministicAnnealing(4, [0.25] * 4)
+        centers = model.initial_centers(X)
+        idx = [np.where((X == c).all(axis=1))[0][0] for c in centers]
+        # k-means++ picks one seed from each well separated blob
+        assert sorted(y[idx]) == [0, 1, 2, 3]
+
+    def test_n_jobs(self):
+        import numpy as np
+        np.random.seed(42)
+        X = np.random.rand(500, 2)
+        model = da.DeterministicAnnealing(4, [0.25] * 4, T=(1e-2, 1e-3), max_cycles=2,
+                                          show_progress=False, n_jobs=2)
+        model.fit(X)
+        assert len(np.unique(model.labels_)) == 4
+        assert (model.predict(X) == model.labels_).mean() > 0.95
+
+    def test_hard_labels(self):
+        import numpy as np
+        from sklearn.datasets import make_blobs
+        X, _ = make_blobs(n_samples=400, centers=[(-10, -10), (-10, 10), (10, -10), (10, 10)],
+                          cluster_std=0.5, random_state=42)
+        model = da.DeterministicAnnealing(4, [0.25] * 4, T=(1e-3,), max_cycles=1, show_progress=False)
+        model.fit(X)
+        X_norm_sq = np.sum(np.square(X), axis=1)
+        distance_matrix = model._distance(X, model.cluster_centers_, X_norm_sq)
+        labels = model._hard_labels(distance_matrix)
+        assert labels is not None
+        exp_term = model._exp_term(distance_matrix)
+        gibbs = model.update_gibbs(model._eta, exp_term)
+        assert (labels == np.argmax(gibbs, axis=1)).all()
+        # soft regime falls back to the gibbs path
+        model.beta = 1e-3
+        assert model._hard_labels(distance_matrix) is None
+
+    def test_cached_distance(self):
+        import numpy as np
+
+        class CachedDA(da.DeterministicAnnealing):
+            def _cached_distance(self, X, centers):
+                self.cache_used = True
+                return super()._cached_distance(X, centers)
+
+        class UncachedDA(da.DeterministicAnnealing):
+            def _cached_distance(self, X, centers):
+                return self._distance(X, centers, self._X_norm_sq)
+
+        da_iter = da.da_iter
+        # the distance cache is only used by the numpy iteration
+        da.da_iter = None
+        try:
+            for seed in [0, 1]:
+                np.random.seed(seed)
+                X = np.random.rand(2000, 2)
+                model = CachedDA(4, [0.25] * 4, show_progress=False)
+                model.fit(X)
+                uncached = UncachedDA(4, [0.25] * 4, show_progress=False)
+                uncached.fit(X)
+                assert model.cache_used
+                assert (model.labels_ == uncached.labels_).all()
+                assert (np.abs(np.bincount(model.labels_, minlength=4) - 500) <= 50).all()
+        finally:
+            da.da_iter = da_iter
+
+    def test_integer_input(self):
+        import numpy as np
+        np.random.seed(42)
+        X = np.random.randint(0, 100, size=(400, 2))
+        model = da.DeterministicAnnealing(4, [0.25] * 4, show_progress=False)
+        model.fit(X)
+        assert len(np.unique(model.labels_)) == 4
+        assert np.isfinite(model.cluster_centers_).all()
+        assert model.predict(X).shape == (400,)
+
+    def test_quantized_convergence(self):
+        import numpy as np
+
+        class CountingDA(da.DeterministicAnnealing):
+            n_iters = 0
+            def on_iter_end(self, i, X, eta, gibbs, centers, labels):
+                self.n_iters += 1
+
+        np.random.seed(0)
+        X = np.random.rand(1000, 2)
+        model = CountingDA(4, [0.25] * 4, show_progress=False)
+        model.fit(X)
+        quantized = CountingDA(4, [0.25] * 4, show_progress=False, dtype='f32')
+        quantized.fit(X)
+        # float32 rounding noise must not keep the early exits from firing
+        assert quantized.n_iters <= 2 * model.n_iters
+        assert len(np.unique(quantized.labels_)) == 4
+
+    def test_low_temperature(self):
+        import numpy as np
+        np.random.seed(1)
+        X = np.random.rand(500, 2)
+        n_clusters = 16
+        da_iter = da.da_iter
+        try:
+            # compiled and numpy iterations
+            for core in [da_iter, None]:
+                da.da_iter = core
+                model = da.DeterministicAnnealing(n_clusters, [1. / n_clusters] * n_clusters,
+                                                  T=(1e-8,), max_cycles=1, show_progress=False)
+                model.fit(X)
+                assert np.isfinite(model.cluster_centers_).all()
+                assert np.isfinite(model._eta).all()
+                assert (np.asarray(model._eta) > 0).all()
+        finally:
+            da.da_iter = da_iter
+
+    def test_warm_start(self):
+        import numpy as np
+
+        class RecordingDA(da.DeterministicAnnealing):
+            def _anneal(self, X, t, centers, eta, *args, **kwargs):
+                start = (centers.copy(), np.array(eta, dtype=float))
+                labels, eta, centers = super(RecordingDA, self)._anneal(X, t, centers, eta, *args, **kwargs)
+                self.runs.append((start, (labels, centers.copy())))
+                return labels, eta, centers
+
+        np.random.seed(0)
+        X = np.random.rand(1000, 2)
+        model = RecordingDA(4, [0.25] * 4, T=(1000, 1e-2), max_cycles=2, show_progress=False)
+        model.runs = []
+        model.fit(X)
+        assert len(model.runs) == 2
+        (_, (labels, centers)), ((next_centers, next_eta), _) = model.runs
+        # the hot T collapses clusters, the next T keeps the surviving centers
+        # and reseeds the collapsed ones on points of X
+        collapsed = np.bincount(labels, minlength=4) == 0
+        assert collapsed.any() and not collapsed.all()
+        assert np.allclose(next_centers[~collapsed], centers[~collapsed])
+        # fit works on X centered by its mean
+        X_centered = X - model._X_mean
+        for center in next_centers[collapsed]:
+            assert (X_centered == center).all(axis=1).any()
+        assert (next_eta[collapsed] == 1.).all()
+        assert len(np.unique(model.labels_)) == 4
+
+    def test_fixed_points(self):
+        import numpy as np
+        np.random.seed(42)
+        X = np.random.rand(500, 2)
+        # point 3 is listed twice and belongs to the last cluster
+        fixed_points = {0: [0, 1, 2, 3], 2: [3, 4], 3: (5,)}
+        gibbs = np.random.rand(500, 4)
+        expected = gibbs.copy()
+        for cluster_id, points_id in fixed_points.items():
+            expected[tuple([points_id])] = 0
+            expected[[points_id], cluster_id] = 1
+        model = da.DeterministicAnnealing(4, [0.25] * 4, T=(1e-2,), max_cycles=1, show_progress=False)
+        assert np.array_equal(model.set_gibbs_fixed_points(gibbs.copy(), fixed_points), expected)
+
+        model = da.DeterministicAnnealing(4, [0.25] * 4, T=(1e-2,), max_cycles=1, show_progress=False)
+        model.fit(X, fixed_points=fixed_points)
+        assert list(model.labels_[:6]) == [0, 0, 0, 2, 2, 3]
+        assert np.allclose(model.cluster_centers_[0], X[[0, 1, 2, 3]].mean(axis=0))
+        # after a fit, the given fixed points are used, not the ones of the fit
+        other_points = {1: [7, 8]}
+        expected = gibbs.copy()
+        expected[[7, 8]] = 0
+        expected[[7, 8], 1] = 1
+        assert np.array_equal(model.set_gibbs_fixed_points(gibbs.copy(), other_points), expected)
+
+    def test_none_refcount(self):
+        import sys
+        import numpy as np
+        np.random.seed(0)
+        X = np.random.rand(3000, 8)
+        model = da.DeterministicAnnealing(4, [0.25] * 4, show_progress=False)
+        model.fit(X)
+        refcount = sys.getrefcount(None)
+        for _ in range(3):
+            model.fit(X)
+        # the distance step must not leak or steal references to None
+        assert sys.getrefcount(None) == refcount
+
+    def test_gemm_distance_fit(self):
+        import numpy as np
+        da_iter = da.da_iter
+        # the ||x||^2 + ||c||^2 - 2 x.c fallback used without simsimd
+        da.da_iter = None
+        try:
+            for seed in [0, 9, 11]:
+                np.random.seed(seed)
+                X = np.random.rand(2000, 2)
+                labels, centers = [], []
+                for offset in [0., 1e6]:
+                    model = da.DeterministicAnnealing(4, [0.25] * 4, show_progress=False)
+                    model._simsimd = None
+                    model.fit(X + offset)
+                    labels.append(model.labels_)
+                    centers.append(model.cluster_centers_ - offset)
+                    assert (np.abs(np.bincount(model.labels_, minlength=4) - 500) <= 50).all()
+                # translation invariant like cdist
+                assert (labels[0] == labels[1]).all()
+                assert np.allclose(centers[0], centers[1], atol=1e-6)
+        finally:
+            da.da_iter = da_iter
+
+    def test_float32_input(self):
+        import numpy as np
+
+        class DtypeDA(da.DeterministicAnnealing):
+            def _anneal(self, X, *args, **kwargs):
+                self.anneal_dtype = X.dtype
+                return super()._anneal(X, *args, **kwargs)
+
+        np.random.seed(0)
+        X = np.random.rand(2000, 2)
+        model = da.DeterministicAnnealing(4, [0.25] * 4, show_progress=False)
+        model.fit(X)
+        model_32 = DtypeDA(4, [0.25] * 4, show_progress=False)
+        model_32.fit(X.astype(np.float32))
+        # float32 X is annealed in float64, like cdist
+        assert model_32.anneal_dtype == np.float64
+        assert (model_32.labels_ == model.labels_).mean() > 0.99
+
+    def test_release_buffers(self):
+        import pickle
+        import numpy as np
+        np.random.seed(0)
+        X = np.random.rand(20000, 8)
+        model = da.DeterministicAnnealing(4, [0.25] * 4, max_iters=20, show_progress=False)
+        model.fit(X)
+        labels = model.predict(X)
+        # labels and demands_prob are kept, not the (n_samples, n_features) work arrays
+        assert len(pickle.dumps(model)) < X.nbytes / 2
+        restored = pickle.loads(pickle.dumps(model))
+        assert (restored.predict(X) == labels).all()
+
+    def test_rescale_T(self):
+        import numpy as np
+        from scipy.spatial.distance import cdist
+        np.random.seed(42)
+        # k-d tree and brute force branches
+        for n_features in [2, 16]:
+            X = np.random.rand(500, n_features)
+            model = da.DeterministicAnnealing(4, [0.25] * 4)
+            model._X_norm_sq = np.sum(np.square(X), axis=1)
+            distance_matrix = cdist(X, X)
+            np.fill_diagonal(distance_matrix, np.inf)
+            n_sampled = da.T_SCALE_SAMPLES if n_features <= da.T_SCALE_KDTREE_MAX_FEATURES \
+                else da.T_SCALE_BRUTE_SAMPLES
+            sample = np.unique(np.linspace(0, 499, min(500, n_sampled)).astype(int))
+            expected = np.median(distance_matrix[sample].min(axis=1))
+            assert np.isclose(model._rescale_T(X), expected)